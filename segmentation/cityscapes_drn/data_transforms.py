@@ -253,6 +253,46 @@ class ToTensor(object):
             return img, torch.LongTensor(np.array(label, dtype=np.int))
 
 
+class FusedToTensorNormalize(object):
+    """Converts a PIL.Image to a normalized torch.FloatTensor of shape
+    (C x H x W) in a single pass over the pixels:
+    (pixel - mean * 255) * (1 / (std * 255)).
+    Folding the [0, 1] scaling into the normalization halves the bytes
+    moved through the CPU cache compared to ToTensor followed by
+    Normalize.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = np.asarray(mean, dtype=np.float32) * 255.0
+        self.inv_std = 1.0 / (np.asarray(std, dtype=np.float32) * 255.0)
+
+    def __call__(self, image, label=None):
+        arr = np.asarray(image, dtype=np.uint8)
+        out = (arr.astype(np.float32) - self.mean) * self.inv_std
+        img = torch.from_numpy(out.transpose(2, 0, 1)).contiguous()
+        if label is None:
+            return img,
+        else:
+            return img, torch.LongTensor(np.array(label, dtype=np.int64))
+
+
+class ToTensorUint8(object):
+    """Converts a PIL.Image or numpy.ndarray (H x W x C) in the range
+    [0, 255] to a torch.ByteTensor of shape (C x H x W), leaving the
+    [0, 1] scaling and normalization to a fused pass on the GPU.
+    Shipping 1 byte/pixel out of the workers also quarters the bytes
+    crossing the DataLoader boundary compared to float32.
+    """
+
+    def __call__(self, pic, label=None):
+        img = torch.from_numpy(
+            np.ascontiguousarray(np.asarray(pic).transpose(2, 0, 1)))
+        if label is None:
+            return img,
+        else:
+            return img, torch.LongTensor(np.array(label, dtype=np.int64))
+
+
 class Compose(object):
     """Composes several transforms together.
     """
@@ -2,12 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
 import math
 import os
 from os.path import exists, join, split
-import threading
 
 import time
 
@@ -19,14 +20,12 @@ import sys
 from PIL import Image
 import torch
 from torch import nn
+import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
 import torch.utils.data as data
 from torchvision import datasets
-from torch.autograd import Variable
 
-import drn
-import data_transforms
 
 sys.path.append(os.path.abspath('../../active_learning'))
 from active_learning import ActiveLearning
@@ -34,11 +33,9 @@ from active_loss import LossPredictionLoss
 from active_learning_utils import *
 from discriminative_learning import *
 
-
-try:
-    from modules import batchnormsync
-except ImportError:
-    pass
+# Crop size is fixed within an epoch, so let cuDNN autotune conv algorithms
+# once for the whole run instead of per active-learning cycle.
+cudnn.benchmark = True
 
 FORMAT = "[%(asctime)-15s %(filename)s:%(lineno)d %(funcName)s] %(message)s"
 logging.basicConfig(format=FORMAT)
@@ -75,22 +72,50 @@ TRIPLET_PALETTE = np.asarray([
     [91, 192, 222, 255]], dtype=np.uint8)
 
 
+def read_path_list(path):
+    # Store the paths as one contiguous numpy bytes array instead of a list
+    # of str: the backing buffer is a single allocation, so forked dataloader
+    # workers keep sharing it copy-on-write instead of dirtying a page per
+    # string refcount touch.
+    # The parsed array is cached next to the txt as a fixed-width .npy so
+    # later runs (and every worker fork) mmap the finished buffer from the
+    # page cache instead of re-reading and re-splitting the text file.
+    cache_path = path + '.npy'
+    if exists(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return np.load(cache_path, mmap_mode='r')
+    with open(path, 'rb') as f:
+        paths = np.asarray([line.strip() for line in f.read().splitlines()])
+    # Per-process temp file + rename so concurrent runs never read a
+    # half-written cache entry.
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.save(f, paths)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass  # read-only dataset dir; just skip the cache
+    return paths
+
+
 def fill_up_weights(up):
     w = up.weight.data
     f = math.ceil(w.size(2) / 2)
     c = (2 * f - 1 - f % 2) / (2. * f)
-    for i in range(w.size(2)):
-        for j in range(w.size(3)):
-            w[0, 0, i, j] = \
-                (1 - math.fabs(i / f - c)) * (1 - math.fabs(j / f - c))
-    for c in range(1, w.size(0)):
-        w[c, 0, :, :] = w[0, 0, :, :]
+    # The bilinear kernel is separable, so build it from two 1d profiles
+    # and broadcast over all output channels in one copy.
+    ki = 1 - (torch.arange(w.size(2), dtype=w.dtype) / f - c).abs()
+    kj = 1 - (torch.arange(w.size(3), dtype=w.dtype) / f - c).abs()
+    w.copy_((ki.unsqueeze(1) * kj.unsqueeze(0)).expand_as(w))
 
 
 class DRNSeg(nn.Module):
     def __init__(self, model_name, classes, pretrained_model=None,
                  pretrained=True, use_torch_up=False):
         super(DRNSeg, self).__init__()
+        # Imported lazily so entry points that never build a model (e.g.
+        # argparse-only --help runs) skip the backbone import cost.
+        import drn
         model = drn.__dict__.get(model_name)(
             pretrained=pretrained, num_classes=1000, remove_last_2_layers=True)
 
@@ -106,7 +131,6 @@ class DRNSeg(nn.Module):
         self.base = model
         self.seg = nn.Conv2d(model.out_dim, classes,
                              kernel_size=1, bias=True)
-        self.softmax = nn.LogSoftmax()
         m = self.seg
         n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
         m.weight.data.normal_(0, math.sqrt(2. / n))
@@ -119,16 +143,37 @@ class DRNSeg(nn.Module):
                                     bias=False)
             fill_up_weights(up)
             up.weight.requires_grad = False
-            self.up = up
-
-    def forward(self, x):
+            # Keep the upsampler weights in NHWC as well, so the whole model
+            # can run with channels_last inputs.
+            self.up = up.to(memory_format=torch.channels_last)
+
+    def forward_logits(self, x):
+        # Pure forward pass returning the raw logits, the pre-upsample seg
+        # output and the feature list; keeping it free of attribute writes
+        # lets torch.compile trace it without graph breaks.
         x = self.base(x)
-        self.active_learning_features = self.base.get_active_learning_features()
+        features = self.base.get_active_learning_features()
         x = self.seg(x)
-        self.active_learning_features.append(x)
+        features.append(x)
         y = self.up(x)
-        self.active_learning_features.append(self.softmax(y))
-        return self.softmax(y), x
+        # Store the raw logits: the active-learning consumers only pool the
+        # map through small FC layers, so writing an extra log-softmax over
+        # the largest tensor in the graph bought nothing.  Apply
+        # F.log_softmax lazily if a consumer ever needs log-probabilities.
+        features.append(y)
+        return y, x, features
+
+    def forward(self, x):
+        y, x, features = self.forward_logits(x)
+        self.active_learning_features = features
+        return y, x
+
+    def script_head(self):
+        # TorchScript fallback for torch builds without torch.compile:
+        # scripting the small seg conv + grouped upsampler removes the
+        # Python dispatch between the backbone and the head.
+        self.seg = torch.jit.script(self.seg)
+        self.up = torch.jit.script(self.up)
 
     def get_active_learning_feature_channel_counts(self):
         return self.channels
@@ -155,27 +200,61 @@ class DRNSeg(nn.Module):
 
 class SegList(torch.utils.data.Dataset):
     def __init__(self, data_dir, phase, transforms, list_dir=None,
-                 out_name=False):
+                 out_name=False, cache_dir=None, has_gt=True):
         self.list_dir = data_dir if list_dir is None else list_dir
         self.data_dir = data_dir
         self.out_name = out_name
         self.phase = phase
         self.transforms = transforms
+        self.cache_dir = cache_dir
+        self.has_gt = has_gt
         self.image_list = None
         self.label_list = None
         self.bbox_list = None
         self.read_lists()
 
+    def _load_image(self, rel_path, rgb=False):
+        # With a cache_dir, each PNG is decoded only once and persisted as a
+        # raw .npy; later epochs read the pixels back through a numpy mmap
+        # (i.e. straight from the OS page cache) instead of re-running the
+        # PNG decoder in every worker.
+        if self.cache_dir is None:
+            # Decode eagerly and close the file handle; with many workers
+            # times prefetch_factor, lazily-held FDs add up.
+            with Image.open(join(self.data_dir, rel_path)) as image:
+                image.load()
+            return image
+        cache_path = join(self.cache_dir, rel_path + '.npy')
+        if not exists(cache_path):
+            image = Image.open(join(self.data_dir, rel_path))
+            if rgb:
+                image = image.convert('RGB')
+            cache_sub_dir = split(cache_path)[0]
+            if not exists(cache_sub_dir):
+                os.makedirs(cache_sub_dir, exist_ok=True)
+            # Write via a per-process temp file so concurrent workers never
+            # see a half-written cache entry.
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(image))
+            os.replace(tmp_path, cache_path)
+        return Image.fromarray(np.load(cache_path, mmap_mode='r'))
+
     def __getitem__(self, index):
-        data = [Image.open(join(self.data_dir, self.image_list[index]))]
-        if self.label_list is not None:
-            mask_path = join(self.data_dir, self.label_list[index])
-            data.append(Image.open(mask_path))
+        data = [self._load_image(self.get_image_path(index), rgb=True)]
+        # has_gt=False skips the label read entirely, halving the per-sample
+        # disk reads when testing without ground truth.
+        if self.label_list is not None and self.has_gt:
+            data.append(self._load_image(self.label_list[index].decode()))
         data = list(self.transforms(*data))
         if self.out_name:
-            if self.label_list is None:
-                data.append(item()[0, :, :])
-            data.append(self.image_list[index])
+            if len(data) == 1:
+                data.append(data[0][0, :, :])
+            # Ship the sample index instead of the path string: a batch of
+            # ints collates to a tensor, so the whole batch stays pinnable
+            # (default pin_memory skips batches holding str elements).  The
+            # consumer resolves it through get_image_path().
+            data.append(index)
         return tuple(data)
 
     def __len__(self):
@@ -185,20 +264,22 @@ class SegList(torch.utils.data.Dataset):
         image_path = join(self.list_dir, self.phase + '_images.txt')
         label_path = join(self.list_dir, self.phase + '_labels.txt')
         assert exists(image_path)
-        self.image_list = [line.strip() for line in open(image_path, 'r')]
+        self.image_list = read_path_list(image_path)
         if exists(label_path):
-            self.label_list = [line.strip() for line in open(label_path, 'r')]
+            self.label_list = read_path_list(label_path)
             assert len(self.image_list) == len(self.label_list)
 
     # Needed for writing csv files to be uploaded to annotate.online.
     def get_image_path(self, index):
-        return self.image_list[index]
+        return self.image_list[index].decode()
 
 
 class SegListMS(torch.utils.data.Dataset):
-    def __init__(self, data_dir, phase, transforms, scales, list_dir=None):
+    def __init__(self, data_dir, phase, transforms, scales, list_dir=None,
+                 has_gt=True):
         self.list_dir = data_dir if list_dir is None else list_dir
         self.data_dir = data_dir
+        self.has_gt = has_gt
         self.phase = phase
         self.transforms = transforms
         self.image_list = None
@@ -208,16 +289,19 @@ class SegListMS(torch.utils.data.Dataset):
         self.scales = scales
 
     def __getitem__(self, index):
-        data = [Image.open(join(self.data_dir, self.image_list[index]))]
-        w, h = item().size
-        if self.label_list is not None:
+        data = [Image.open(
+            join(self.data_dir, self.image_list[index].decode()))]
+        w, h = data[0].size
+        if self.label_list is not None and self.has_gt:
             data.append(Image.open(
-                join(self.data_dir, self.label_list[index])))
+                join(self.data_dir, self.label_list[index].decode())))
         out_data = list(self.transforms(*data))
-        ms_images = [self.transforms(item().resize((int(w * s), int(h * s)),
+        ms_images = [self.transforms(data[0].resize((int(w * s), int(h * s)),
                                                     Image.BICUBIC))[0]
                      for s in self.scales]
-        out_data.append(self.image_list[index])
+        # Index instead of path string, for the same pin_memory reason as
+        # SegList; see get_image_path().
+        out_data.append(index)
         out_data.extend(ms_images)
         return tuple(out_data)
 
@@ -228,71 +312,128 @@ class SegListMS(torch.utils.data.Dataset):
         image_path = join(self.list_dir, self.phase + '_images.txt')
         label_path = join(self.list_dir, self.phase + '_labels.txt')
         assert exists(image_path)
-        self.image_list = [line.strip() for line in open(image_path, 'r')]
+        self.image_list = read_path_list(image_path)
         if exists(label_path):
-            self.label_list = [line.strip() for line in open(label_path, 'r')]
+            self.label_list = read_path_list(label_path)
             assert len(self.image_list) == len(self.label_list)
 
+    def get_image_path(self, index):
+        return self.image_list[index].decode()
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Yields batches of indices whose images share the same (W, H), so
+    evaluation on variable-shape datasets can batch past batch_size=1.
+    On Cityscapes every val image is 2048 x 1024, so this degenerates to
+    plain sequential batching; mixed-size sets get one bucket per shape.
+    Sizes come from the PNG headers at init (PIL decodes lazily, so this
+    reads a few dozen bytes per file).
+    """
+
+    def __init__(self, dataset, max_batch):
+        buckets = {}
+        for index in range(len(dataset)):
+            path = join(dataset.data_dir, dataset.get_image_path(index))
+            with Image.open(path) as im:
+                buckets.setdefault(im.size, []).append(index)
+        self.batches = []
+        for indices in buckets.values():
+            for i in range(0, len(indices), max_batch):
+                self.batches.append(indices[i:i + max_batch])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def amp_dtype():
+    # bf16 keeps the fp32 exponent range and needs no loss scaling, so
+    # prefer it on hardware that supports it (Ampere and newer).
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
 
+def normalize_gpu(input, mean, std):
+    """Fused uint8 -> float conversion and per-channel normalization,
+    executed on the device the input already lives on.  mean and std are
+    (1, C, 1, 1) tensors built once per run (see train_seg), so no host
+    list is re-materialized per batch.
+    """
+    return input.float().div_(255).sub_(mean).div_(std)
+
+
+@torch.inference_mode()
 def validate(val_loader, model, criterion, eval_score=None, print_freq=40, num_classes=1000,
-             use_loss_prediction_al=False, use_discriminative_al=False):
+             use_loss_prediction_al=False, use_discriminative_al=False,
+             mean=None, std=None):
     batch_time = AverageMeter()
     losses = AverageMeter()
     score = AverageMeter()
-    mAP = AverageMeter()
 
     # switch to evaluate mode
     model.eval()
 
     end = time.time()
-    hist = np.zeros((num_classes, num_classes))
+    hist = torch.zeros(num_classes, num_classes, dtype=torch.int64,
+                       device='cuda')
     for i, (input, target) in enumerate(val_loader):
         if type(criterion) in [torch.nn.modules.loss.L1Loss,
                                torch.nn.modules.loss.MSELoss]:
             target = target.float()
-        input = input.cuda()
+        input = input.cuda(non_blocking=True).to(
+            memory_format=torch.channels_last)
+        if mean is not None:
+            input = normalize_gpu(input, mean, std)
         target = target.cuda(non_blocking=True)
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
 
         # compute output
-        if use_loss_prediction_al or use_discriminative_al:
-            output = model(input_var)[0][0]
-        else:
-            output = model(input_var)[0]
-        loss = criterion(output, target_var).mean()
+        with torch.cuda.amp.autocast(dtype=amp_dtype()):
+            if use_loss_prediction_al or use_discriminative_al:
+                output = model(input)[0][0]
+            else:
+                output = model(input)[0]
+            loss = criterion(output, target).mean()
 
         # measure accuracy and record loss
         # prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
-        losses.update(loss.item(), input.size(0))
+        # Keep the scalar on the device; it only reaches the host when the
+        # logging format string renders it at print_freq.
+        losses.update(loss, input.size(0))
         if eval_score is not None:
-            score.update(eval_score(output, target_var), input.size(0))
+            score.update(eval_score(output, target), input.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
 
         _, pred = torch.max(output, 1)
-        pred = pred.cpu().data.numpy()
-        label = target.cpu().numpy()
         # Remove the 'background' class and compute the matrix hist, where
         # hist[i][j] is the number of pixels for which ground truth class
-        # was i, but predicted j.
-        hist += fast_hist(pred.flatten(), label.flatten(), num_classes)
-        current_mAP = round(np.nanmean(per_class_iu(hist)) * 100, 2)
-        mAP.update(current_mAP)
+        # was i, but predicted j.  The histogram stays on the GPU; we only
+        # pull scalars back to the host for logging.
+        hist += fast_hist_torch(pred.flatten(), target.flatten(), num_classes)
         if i % print_freq == 0:
+            # The running mIoU is only a progress indicator, so evaluate it
+            # (three passes over the histogram plus a host sync) at logging
+            # time instead of every batch.
+            current_mAP = round(
+                np.nanmean(per_class_iu_torch(hist).cpu().numpy()) * 100, 2)
             logger.info('Test: [{0}/{1}]\t'
                         'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                         'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
                         'Score {score.val:.3f} ({score.avg:.3f})\t'
-                        'mAP {mAP.val:.3f} ({mAP.avg:.3f})'.format(
+                        'mAP {mAP:.3f}'.format(
                 i, len(val_loader), batch_time=batch_time, loss=losses,
-                score=score, mAP=mAP))
+                score=score, mAP=current_mAP))
 
     logger.info(' * Score {top1.avg:.3f}'.format(top1=score))
 
-    return score.avg, mAP.avg
+    final_mAP = round(
+        np.nanmean(per_class_iu_torch(hist).cpu().numpy()) * 100, 2)
+    return score.avg, final_mAP
 
 
 class AverageMeter(object):
@@ -314,21 +455,19 @@ class AverageMeter(object):
 
 
 def accuracy(output, target):
-    """Computes the precision@k for the specified values of k"""
-    # batch_size = target.size(0) * target.size(1) * target.size(2)
+    """Computes the pixel accuracy, ignoring the 255 'void' label"""
     _, pred = output.max(1)
-    pred = pred.view(1, -1)
-    target = target.view(1, -1)
-    correct = pred.eq(target)
-    correct = correct[target != 255]
-    correct = correct.view(-1)
-    score = correct.float().sum(0).mul(100.0 / correct.size(0))
-    return score.item()
+    valid = target.ne(255)
+    correct = (pred.eq(target) & valid).sum()
+    # Return the 0-dim tensor instead of calling .item(): the masked sum is
+    # one kernel and the callers accumulate on-device, so the per-batch
+    # GPU->CPU sync disappears from the inner loops.
+    return correct.float().mul(100.0).div(valid.sum().clamp_min(1).float())
 
 
 def train(train_loader, model, criterion, optimizer, epoch,
-          eval_score=None, print_freq=100, use_loss_prediction_al=False, active_learning_lamda=1, 
-          use_discriminative_al=False):
+          eval_score=None, print_freq=100, use_loss_prediction_al=False, active_learning_lamda=1,
+          use_discriminative_al=False, mean=None, std=None, scaler=None):
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -352,38 +491,44 @@ def train(train_loader, model, criterion, optimizer, epoch,
                                torch.nn.modules.loss.MSELoss]:
             target = target.float()
 
-        input = input.cuda()
+        input = input.cuda(non_blocking=True).to(
+            memory_format=torch.channels_last)
+        if mean is not None:
+            input = normalize_gpu(input, mean, std)
         target = target.cuda(non_blocking=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
 
         # compute output
-        if use_loss_prediction_al:
-            if epoch < 150:
-                output, loss_pred = model(input_var)
+        with torch.cuda.amp.autocast(dtype=amp_dtype(), enabled=scaler is not None):
+            if use_loss_prediction_al:
+                if epoch < 150:
+                    output, loss_pred = model(input)
+                else:
+                    output, loss_pred = model(input, detach_lp=True)
+                output = output[0]
+            elif use_discriminative_al:
+                output, labeled_unlabeled_predictions = model(input)
             else:
-                output, loss_pred = model(input_var, detach_lp=True)
-            output = output[0]
-        elif use_discriminative_al:
-            output, labeled_unlabeled_predictions = model(input_var)
-        else:
-            output = model(input_var)[0]
+                output = model(input)[0]
 
-        loss = criterion(output, target_var)
+            loss = criterion(output, target)
 
-        # Compute means from [N, W, H] to [N].
-        loss = loss.mean([1, 2])
+            # Compute means from [N, W, H] to [N].
+            loss = loss.mean([1, 2])
         # Let the main model "warm-up" for a while, loss prediction does not
         # work well otherwise.
         if use_loss_prediction_al and epoch > 1:
             loss_prediction_loss = criterion_lp(loss_pred, loss)
             # Also compute (an estimate) of the ranking accuracy for the training set.
-            batch_size = loss.shape[0]
-            for l1 in range(batch_size):
-                for l2 in range(l1):
-                    total_ranked += 1
-                    if (loss[l1] - loss[l2]) * (loss_pred[l1] - loss_pred[l2]) > 0:
-                        correctly_ranked += 1
+            # All pairs are compared in one kernel; the counters stay on the
+            # device so the loop does not sync the GPU O(B^2) times per step.
+            with torch.no_grad():
+                d_loss = loss.unsqueeze(0) - loss.unsqueeze(1)
+                pred_flat = loss_pred.detach().flatten()
+                d_pred = pred_flat.unsqueeze(0) - pred_flat.unsqueeze(1)
+                pair_mask = torch.triu(
+                    torch.ones_like(d_loss, dtype=torch.bool), diagonal=1)
+                correctly_ranked += (((d_loss * d_pred) > 0) & pair_mask).sum()
+                total_ranked += pair_mask.sum()
             if i % print_freq == 0:
                 logger.info(
                     "loss.mean() = {} active_learning_lamda = {}, loss_prediction_loss = {}".format(
@@ -396,12 +541,17 @@ def train(train_loader, model, criterion, optimizer, epoch,
         # prec1, prec5 = accuracy(output.data, target, topk=(1, 5))
         losses.update(loss.item(), input.size(0))
         if eval_score is not None:
-            scores.update(eval_score(output, target_var), input.size(0))
+            scores.update(eval_score(output, target), input.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -417,7 +567,7 @@ def train(train_loader, model, criterion, optimizer, epoch,
                 get_algorithm_name(use_loss_prediction_al, use_discriminative_al, None),
                 epoch, i, len(train_loader), batch_time=batch_time,
                 data_time=data_time, loss=losses, top1=scores,
-                ranking_accuracy=correctly_ranked/(total_ranked+0.00001)))
+                ranking_accuracy=float(correctly_ranked) / (float(total_ranked) + 0.00001)))
 
 
 def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
@@ -426,7 +576,18 @@ def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
         shutil.copyfile(filename, 'model_best.pth.tar')
 
 
+def strip_compile_prefix(state_dict):
+    # torch.compile wraps the model in an OptimizedModule whose state_dict
+    # keys carry an '_orig_mod.' prefix.  Strip it so checkpoints load into
+    # the plain module no matter which path wrote them.
+    prefix = '_orig_mod.'
+    return {key[len(prefix):] if key.startswith(prefix) else key: value
+            for key, value in state_dict.items()}
+
+
 def train_seg(args):
+    import data_transforms
+
     rand_state = np.random.RandomState(1311)
     torch.manual_seed(1311)
     device = 'cuda' if (torch.cuda.is_available()) else 'cpu'
@@ -449,48 +610,91 @@ def train_seg(args):
     info = json.load(open(join(data_dir, 'info.json'), 'r'))
     normalize = data_transforms.Normalize(mean=info['mean'],
                                      std=info['std'])
+    # Device-resident copies for the fused GPU normalization; built once so
+    # train/validate never rebuild tensors from the info.json lists.
+    mean_gpu = torch.tensor(
+        info['mean'], dtype=torch.float32).view(1, -1, 1, 1).cuda()
+    std_gpu = torch.tensor(
+        info['std'], dtype=torch.float32).view(1, -1, 1, 1).cuda()
     t = []
     if args.random_rotate > 0:
         t.append(data_transforms.RandomRotate(args.random_rotate))
     if args.random_scale > 0:
         t.append(data_transforms.RandomScale(args.random_scale))
+    # Geometric augmentations stay on PIL inside the workers, but the pixels
+    # travel to the trainer as uint8; scaling and normalization run as one
+    # fused pass on the GPU (see normalize_gpu).
     t.extend([data_transforms.RandomCrop(crop_size),
               data_transforms.RandomHorizontalFlip(),
-              data_transforms.ToTensor(),
-              normalize])
+              data_transforms.ToTensorUint8()])
     dataset = SegList(data_dir, 'train', data_transforms.Compose(t),
-                list_dir=args.list_dir)
+                list_dir=args.list_dir, cache_dir=args.cache_dir)
     training_dataset_no_augmentation = SegList(
         data_dir, 'train',
         data_transforms.Compose([data_transforms.ToTensor(), normalize]),
-        list_dir=args.list_dir
+        list_dir=args.list_dir, cache_dir=args.cache_dir
+    )
+
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=True,
+                         drop_last=True)
+    if num_workers > 0:
+        # Keep the workers alive across epochs (and cycles) instead of
+        # paying the multi-second spawn cost for every epoch.
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # The validation set does not change across cycles, so build its loader
+    # (and its workers) only once.
+    val_loader = torch.utils.data.DataLoader(
+        SegList(data_dir, 'val', data_transforms.Compose([
+            data_transforms.RandomCrop(crop_size),
+            data_transforms.ToTensorUint8(),
+        ]), list_dir=args.list_dir, cache_dir=args.cache_dir),
+        batch_size=batch_size, shuffle=False, **loader_kwargs
     )
 
+    # Build the model a single time: constructing DRNSeg hits the torch hub
+    # / disk for the pretrained backbone, which would otherwise be repaid on
+    # every cycle.  Each cycle restores the snapshotted initial weights
+    # instead, which also keeps cuDNN's autotune cache (keyed on the live
+    # modules) warm across cycles.
+    single_model = DRNSeg(args.arch, args.classes, None,
+                          pretrained=True)
+    if args.pretrained:
+        single_model.load_state_dict(torch.load(args.pretrained))
+
+    # Wrap our model in Active Learning Model.
+    if args.use_loss_prediction_al:
+        single_model = ActiveLearning(
+            single_model, global_avg_pool_size=6, fc_width=256)
+    elif args.use_discriminative_al:
+        single_model = DiscriminativeActiveLearning(single_model)
+
+    model = torch.nn.DataParallel(single_model).cuda()
+    # NHWC unlocks the faster tensor-core conv kernels on Ampere+.
+    model = model.to(memory_format=torch.channels_last)
+    if hasattr(torch, 'compile'):
+        model = torch.compile(model, mode='max-autotune', fullgraph=False)
+    else:
+        # The AL wrappers keep the DRNSeg under base_model.
+        drn_seg = getattr(single_model, 'base_model', single_model)
+        drn_seg.script_head()
+    init_state = copy.deepcopy(single_model.state_dict())
+
+    # Don't apply a 'mean' reduction, we need the whole loss vector.
+    # The model returns raw logits, so the log-softmax is fused inside
+    # the cross entropy kernel instead of running as a separate layer.
+    criterion = nn.CrossEntropyLoss(ignore_index=255, reduction='none')
+
+    criterion.cuda()
+
     unlabeled_idx = list(range(len(dataset)))
     labeled_idx = []
     validation_accuracies = list()
     validation_mAPs = list()
     progress = tqdm.tqdm(range(10))
     for cycle in progress:
-        single_model = DRNSeg(args.arch, args.classes, None,
-                              pretrained=True)
-        if args.pretrained:
-            single_model.load_state_dict(torch.load(args.pretrained))
-
-        # Wrap our model in Active Learning Model.
-        if args.use_loss_prediction_al:
-            single_model = ActiveLearning(
-                single_model, global_avg_pool_size=6, fc_width=256)
-        elif args.use_discriminative_al:
-            single_model = DiscriminativeActiveLearning(single_model)
-        optim_parameters = single_model.optim_parameters()
-
-        model = torch.nn.DataParallel(single_model).cuda()
-
-        # Don't apply a 'mean' reduction, we need the whole loss vector.
-        criterion = nn.NLLLoss(ignore_index=255, reduction='none')
-
-        criterion.cuda()
+        # Start every cycle from the same initial weights.
+        single_model.load_state_dict(init_state)
 
         if args.choose_images_with_highest_loss:
             # Choosing images based on the ground truth labels. 
@@ -514,26 +718,21 @@ def train_seg(args):
 
         train_loader = torch.utils.data.DataLoader(
             data.Subset(dataset, labeled_idx),
-            batch_size=batch_size, shuffle=True, num_workers=num_workers,
-            pin_memory=True, drop_last=True
-        )
-        val_loader = torch.utils.data.DataLoader(
-            SegList(data_dir, 'val', data_transforms.Compose([
-                data_transforms.RandomCrop(crop_size),
-                data_transforms.ToTensor(),
-                normalize,
-            ]), list_dir=args.list_dir),
-            batch_size=batch_size, shuffle=False, num_workers=num_workers,
-            pin_memory=True, drop_last=True
+            batch_size=batch_size, shuffle=True, **loader_kwargs
         )
 
         # define loss function (criterion) and optimizer.
-        optimizer = torch.optim.SGD(optim_parameters,
+        # optim_parameters() is a generator, so ask for a fresh one when
+        # rebuilding the (cheap) optimizer each cycle.
+        optimizer = torch.optim.SGD(single_model.optim_parameters(),
                                     args.lr,
                                     momentum=args.momentum,
                                     weight_decay=args.weight_decay)
+        # Loss scaling is only needed for fp16; with bf16 the scaler is a
+        # passthrough but the autocast region still runs on tensor cores.
+        scaler = torch.cuda.amp.GradScaler(
+            enabled=amp_dtype() == torch.float16)
 
-        cudnn.benchmark = True
         best_prec1 = 0
         best_mAP = 0
         start_epoch = 0
@@ -545,7 +744,10 @@ def train_seg(args):
                 checkpoint = torch.load(args.resume)
                 start_epoch = checkpoint['epoch']
                 best_prec1 = checkpoint['best_prec1']
-                model.load_state_dict(checkpoint['state_dict'])
+                # Load into the uncompiled wrapper so both old (module.*)
+                # and compiled-era (_orig_mod.module.*) checkpoints resume.
+                getattr(model, '_orig_mod', model).load_state_dict(
+                    strip_compile_prefix(checkpoint['state_dict']))
                 print("=> loaded checkpoint '{}' (epoch {})"
                       .format(args.resume, checkpoint['epoch']))
             else:
@@ -554,7 +756,8 @@ def train_seg(args):
         if args.evaluate:
             validate(val_loader, model, criterion, eval_score=accuracy,
                      num_classes=args.classes,
-                     use_loss_prediction_al=args.use_loss_prediction_al)
+                     use_loss_prediction_al=args.use_loss_prediction_al,
+                     mean=mean_gpu, std=std_gpu)
             return
 
         progress_epoch = tqdm.tqdm(range(start_epoch, args.epochs))
@@ -563,13 +766,15 @@ def train_seg(args):
             logger.info('Cycle {0} Epoch: [{1}]\tlr {2:.06f}'.format(cycle, epoch, lr))
             # train for one epoch
             train(train_loader, model, criterion, optimizer, epoch,
-                  eval_score=accuracy, use_loss_prediction_al=args.use_loss_prediction_al, 
-                  active_learning_lamda=args.lamda)
+                  eval_score=accuracy, use_loss_prediction_al=args.use_loss_prediction_al,
+                  active_learning_lamda=args.lamda,
+                  mean=mean_gpu, std=std_gpu, scaler=scaler)
 
             # evaluate on validation set
             prec1, mAP1 = validate(val_loader, model, criterion, eval_score=accuracy,
                              num_classes=args.classes,
-                             use_loss_prediction_al=args.use_loss_prediction_al)
+                             use_loss_prediction_al=args.use_loss_prediction_al,
+                             mean=mean_gpu, std=std_gpu)
 
             is_best = prec1 > best_prec1
             best_prec1 = max(prec1, best_prec1)
@@ -578,7 +783,9 @@ def train_seg(args):
             save_checkpoint({
                 'epoch': epoch + 1,
                 'arch': args.arch,
-                'state_dict': model.state_dict(),
+                # Save the uncompiled module's state so the checkpoint keys
+                # stay 'module.*' and keep loading in uncompiled consumers.
+                'state_dict': getattr(model, '_orig_mod', model).state_dict(),
                 'best_prec1': best_prec1,
                 'best_mAP': best_mAP,
             }, is_best, filename=checkpoint_path)
@@ -623,8 +830,27 @@ def fast_hist(pred, label, n):
         n * label[k].astype(int) + pred[k], minlength=n ** 2).reshape(n, n)
 
 
+def fast_hist_torch(pred, label, n):
+    # Same as fast_hist, but runs on the device the tensors live on, so the
+    # prediction/label maps never have to be copied back to the host.
+    k = (label >= 0) & (label < n)
+    return torch.bincount(
+        n * label[k].long() + pred[k].long(), minlength=n ** 2).reshape(n, n)
+
+
+def per_class_iu_torch(hist):
+    diag = torch.diag(hist).float()
+    denom = (hist.sum(1) + hist.sum(0) - torch.diag(hist)).float()
+    return torch.where(denom > 0, diag / denom.clamp_min(1),
+                       torch.full_like(diag, float('nan')))
+
+
 def per_class_iu(hist):
-    return np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
+    diag = np.diag(hist)
+    denom = hist.sum(1) + hist.sum(0) - diag
+    # Keep NaN for classes absent from both prediction and ground truth (so
+    # np.nanmean still skips them) without tripping divide-by-zero warnings.
+    return np.where(denom > 0, diag / np.maximum(denom, 1), np.nan)
 
 
 def save_output_images(predictions, filenames, output_dir):
@@ -636,106 +862,177 @@ def save_output_images(predictions, filenames, output_dir):
     for ind in range(len(filenames)):
         im = Image.fromarray(predictions[ind].astype(np.uint8))
         fn = os.path.join(output_dir, filenames[ind][:-4] + '.png')
-        out_dir = split(fn)[0]
-        if not exists(out_dir):
-            os.makedirs(out_dir)
+        # exist_ok: these saves may run concurrently from the writer pool.
+        os.makedirs(split(fn)[0], exist_ok=True)
         im.save(fn)
 
 
+_FLAT_PALETTES = {}
+
+
+def _flat_palette(palettes):
+    # 768-entry PIL palette list, built once per palette array and cached;
+    # save_colorful_images runs per batch, so don't rebuild it every call.
+    key = palettes.tobytes()
+    flat = _FLAT_PALETTES.get(key)
+    if flat is None:
+        flat = palettes[:, :3].astype(np.uint8).flatten().tolist()
+        flat += [0] * (768 - len(flat))
+        _FLAT_PALETTES[key] = flat
+    return flat
+
+
 def save_colorful_images(predictions, filenames, output_dir, palettes):
-   """
-   Saves a given (B x C x H x W) into an image file.
-   If given a mini-batch tensor, will save the tensor as a grid of images.
-   """
-   for ind in range(len(filenames)):
-       im = Image.fromarray(palettes[predictions[ind].squeeze()])
-       fn = os.path.join(output_dir, filenames[ind][:-4] + '.png')
-       out_dir = split(fn)[0]
-       if not exists(out_dir):
-           os.makedirs(out_dir)
-       im.save(fn)
+    """
+    Saves a given (B x C x H x W) into an image file.
+    If given a mini-batch tensor, will save the tensor as a grid of images.
+    """
+    # A paletted PNG stores 1 byte/pixel, so attach the palette to the raw
+    # class-index map instead of materializing an H x W x 3 RGB copy.
+    flat_palette = _flat_palette(palettes)
+    for ind in range(len(filenames)):
+        im = Image.fromarray(predictions[ind].squeeze().astype(np.uint8),
+                             mode='P')
+        im.putpalette(flat_palette)
+        fn = os.path.join(output_dir, filenames[ind][:-4] + '.png')
+        os.makedirs(split(fn)[0], exist_ok=True)
+        im.save(fn, optimize=False, compress_level=1)
+
+
+class CUDAPrefetcher(object):
+    """Wraps a DataLoader and stages the next batch's image tensors on the
+    GPU via a side stream, so the H2D copy of batch N+1 overlaps with the
+    forward pass of batch N (the APEX data_prefetcher pattern).  Integer
+    tensors (labels) and filename strings pass through untouched.
+    """
 
+    def __init__(self, loader):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.stream = torch.cuda.Stream()
+        self._iter = None
+        self._next = None
 
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self):
+        try:
+            batch = next(self._iter)
+        except StopIteration:
+            self._next = None
+            return
+        with torch.cuda.stream(self.stream):
+            # Move the image tensors (float, or uint8 when normalization
+            # happens on the GPU); integer labels stay on the host.
+            self._next = tuple(
+                item.cuda(non_blocking=True)
+                if torch.is_tensor(item) and
+                (item.is_floating_point() or item.dtype == torch.uint8)
+                else item
+                for item in batch)
+
+    def __iter__(self):
+        self._iter = iter(self.loader)
+        self._preload()
+        while self._next is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = self._next
+            for item in batch:
+                if torch.is_tensor(item) and item.is_cuda:
+                    item.record_stream(torch.cuda.current_stream())
+            self._preload()
+            yield batch
+
+
+@torch.inference_mode()
 def test(eval_data_loader, model, num_classes,
-         output_dir='pred', has_gt=True, save_vis=False):
+         output_dir='pred', has_gt=True, save_vis=False,
+         mean=None, std=None, amp=False):
     model.eval()
     batch_time = AverageMeter()
     data_time = AverageMeter()
     end = time.time()
-    hist = np.zeros((num_classes, num_classes))
+    hist = torch.zeros(num_classes, num_classes, dtype=torch.int64,
+                       device='cuda')
+    io_pool = ThreadPoolExecutor(max_workers=4)
+    io_futures = []
     for iter, (image, label, name) in enumerate(eval_data_loader):
         data_time.update(time.time() - end)
-        image_var = Variable(image, requires_grad=False, volatile=True)
-        final = model(image_var)[0]
+        image = image.cuda(non_blocking=True).to(
+            memory_format=torch.channels_last)
+        if mean is not None:
+            image = normalize_gpu(image, mean, std)
+        with torch.cuda.amp.autocast(dtype=amp_dtype(), enabled=amp):
+            final = model(image)[0]
         _, pred = torch.max(final, 1)
-        pred = pred.cpu().data.numpy()
         batch_time.update(time.time() - end)
         if save_vis:
-            save_output_images(pred, name, output_dir)
-            save_colorful_images(
-                pred, name, output_dir + '_color',
-                TRIPLET_PALETTE if num_classes == 3 else CITYSCAPE_PALETTE)
+            pred_np = pred.cpu().numpy()
+            # name holds sample indices (see SegList.__getitem__); resolve
+            # them to filenames here on the main process.
+            names = [eval_data_loader.dataset.get_image_path(int(i))
+                     for i in name]
+            # PNG encode + fs write release the GIL, so hand them to the
+            # writer pool and let the next forward start immediately.
+            io_futures.append(io_pool.submit(
+                save_output_images, pred_np, names, output_dir))
+            io_futures.append(io_pool.submit(
+                save_colorful_images, pred_np, names, output_dir + '_color',
+                TRIPLET_PALETTE if num_classes == 3 else CITYSCAPE_PALETTE))
         if has_gt:
-            label = label.numpy()
-            hist += fast_hist(pred.flatten(), label.flatten(), num_classes)
+            # One bincount kernel per batch on the device; neither the
+            # prediction nor the label map crosses to the host.
+            label = label.cuda(non_blocking=True)
+            hist += fast_hist_torch(pred.flatten(), label.flatten(),
+                                    num_classes)
             logger.info('===> mAP {mAP:.3f}'.format(
-                mAP=round(np.nanmean(per_class_iu(hist)) * 100, 2)))
+                mAP=round(np.nanmean(
+                    per_class_iu_torch(hist).cpu().numpy()) * 100, 2)))
         end = time.time()
         logger.info('Eval: [{0}/{1}]\t'
                     'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                     'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
                     .format(iter, len(eval_data_loader), batch_time=batch_time,
                             data_time=data_time))
+    # Block until every queued PNG hits disk before reporting results;
+    # result() re-raises any write failure that would otherwise be
+    # swallowed by the pool.
+    for future in io_futures:
+        future.result()
+    io_pool.shutdown(wait=True)
     if has_gt: #val
-        ious = per_class_iu(hist) * 100
+        ious = per_class_iu_torch(hist).cpu().numpy() * 100
         logger.info(' '.join('{:.03f}'.format(i) for i in ious))
         return round(np.nanmean(ious), 2)
 
 
 def resize_4d_tensor(tensor, width, height):
-    tensor_cpu = tensor.cpu().numpy()
     if tensor.size(2) == height and tensor.size(3) == width:
-        return tensor_cpu
-    out_size = (tensor.size(0), tensor.size(1), height, width)
-    out = np.empty(out_size, dtype=np.float32)
-
-    def resize_one(i, j):
-        out[i, j] = np.array(
-            Image.fromarray(tensor_cpu[i, j]).resize(
-                (width, height), Image.BILINEAR))
-
-    def resize_channel(j):
-        for i in range(tensor.size(0)):
-            out[i, j] = np.array(
-                Image.fromarray(tensor_cpu[i, j]).resize(
-                    (width, height), Image.BILINEAR))
-
-    # workers = [threading.Thread(target=resize_one, args=(i, j))
-    #            for i in range(tensor.size(0)) for j in range(tensor.size(1))]
-
-    workers = [threading.Thread(target=resize_channel, args=(j,))
-               for j in range(tensor.size(1))]
-    for w in workers:
-        w.start()
-    for w in workers:
-        w.join()
-    # for i in range(tensor.size(0)):
-    #     for j in range(tensor.size(1)):
-    #         out[i, j] = np.array(
-    #             Image.fromarray(tensor_cpu[i, j]).resize(
-    #                 (w, h), Image.BILINEAR))
-    # out = tensor.new().resize_(*out.shape).copy_(torch.from_numpy(out))
-    return out
+        return tensor
+    # Resize all N x C maps in one bilinear kernel, staying on the device
+    # instead of round-tripping through numpy/PIL per channel.
+    return F.interpolate(tensor, size=(height, width), mode='bilinear',
+                         align_corners=False)
 
 
+@torch.inference_mode()
 def test_ms(eval_data_loader, model, num_classes, scales,
-            output_dir='pred', has_gt=True, save_vis=False):
+            output_dir='pred', has_gt=True, save_vis=False,
+            mean=None, std=None, amp=False):
     model.eval()
     batch_time = AverageMeter()
     data_time = AverageMeter()
     end = time.time()
-    hist = np.zeros((num_classes, num_classes))
+    hist = torch.zeros(num_classes, num_classes, dtype=torch.int64,
+                       device='cuda')
     num_scales = len(scales)
+    # One stream per scale (plus the base image): the 0.5/0.75 forwards
+    # are too small to fill the GPU on their own, so letting them run
+    # concurrently hides most of their cost behind the larger scales.
+    streams = [torch.cuda.Stream() for _ in range(num_scales + 1)]
+    io_pool = ThreadPoolExecutor(max_workers=4)
+    io_futures = []
     for iter, input_data in enumerate(eval_data_loader):
         data_time.update(time.time() - end)
         if has_gt:
@@ -743,42 +1040,72 @@ def test_ms(eval_data_loader, model, num_classes, scales,
             label = input_data[1]
         else:
             name = input_data[1]
-        h, w = input_item().size()[2:4]
-        images = [input_item()]
+        h, w = input_data[0].size()[2:4]
+        images = [input_data[0]]
         images.extend(input_data[-num_scales:])
         # pdb.set_trace()
-        outputs = []
-        for image in images:
-            image_var = Variable(image, requires_grad=False, volatile=True)
-            final = model(image_var)[0]
-            outputs.append(final.data)
-        final = sum([resize_4d_tensor(out, w, h) for out in outputs])
-        # _, pred = torch.max(torch.from_numpy(final), 1)
-        # pred = pred.cpu().numpy()
-        pred = final.argmax(axis=1)
+        outputs = [None] * len(images)
+        current = torch.cuda.current_stream()
+        for i, image in enumerate(images):
+            streams[i].wait_stream(current)
+            with torch.cuda.stream(streams[i]):
+                image = image.cuda(non_blocking=True).to(
+                    memory_format=torch.channels_last)
+                if mean is not None:
+                    image = normalize_gpu(image, mean, std)
+                with torch.cuda.amp.autocast(dtype=amp_dtype(), enabled=amp):
+                    final = model(image)[0]
+                # Accumulate across scales in fp32 so the sum/argmax below
+                # is unaffected by the reduced-precision forward.
+                outputs[i] = final.float()
+        # Join the side streams before the reduction below touches their
+        # outputs on the default stream.
+        for stream in streams:
+            current.wait_stream(stream)
+        # Stack the per-scale maps and reduce them in one kernel instead of
+        # a chain of pairwise adds from Python's sum().  These are raw
+        # logits: softmax is monotonic per pixel, so argmax over the summed
+        # logits picks the same labels without the exp/sum/div pass.
+        resized = [resize_4d_tensor(out, w, h) for out in outputs]
+        final = torch.stack(resized).sum(0)
+        pred = final.argmax(1)
         batch_time.update(time.time() - end)
         if save_vis:
-            save_output_images(pred, name, output_dir)
-            save_colorful_images(pred, name, output_dir + '_color',
-                                 CITYSCAPE_PALETTE)
+            pred_np = pred.cpu().numpy()
+            names = [eval_data_loader.dataset.get_image_path(int(i))
+                     for i in name]
+            io_futures.append(io_pool.submit(
+                save_output_images, pred_np, names, output_dir))
+            io_futures.append(io_pool.submit(
+                save_colorful_images, pred_np, names,
+                output_dir + '_color', CITYSCAPE_PALETTE))
         if has_gt:
-            label = label.numpy()
-            hist += fast_hist(pred.flatten(), label.flatten(), num_classes)
+            # Accumulate the confusion matrix on the device; only the
+            # 19x19 hist is read back, and only for logging.
+            label = label.cuda(non_blocking=True)
+            hist += fast_hist_torch(pred.flatten(), label.flatten(),
+                                    num_classes)
             logger.info('===> mAP {mAP:.3f}'.format(
-                mAP=round(np.nanmean(per_class_iu(hist)) * 100, 2)))
+                mAP=round(np.nanmean(
+                    per_class_iu_torch(hist).cpu().numpy()) * 100, 2)))
         end = time.time()
         logger.info('Eval: [{0}/{1}]\t'
                     'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                     'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
                     .format(iter, len(eval_data_loader), batch_time=batch_time,
                             data_time=data_time))
+    for future in io_futures:
+        future.result()
+    io_pool.shutdown(wait=True)
     if has_gt: #val
-        ious = per_class_iu(hist) * 100
+        ious = per_class_iu_torch(hist).cpu().numpy() * 100
         logger.info(' '.join('{:.03f}'.format(i) for i in ious))
         return round(np.nanmean(ious), 2)
 
 
 def test_seg(args):
+    import data_transforms
+
     batch_size = args.batch_size
     num_workers = args.workers
     phase = args.phase
@@ -791,26 +1118,50 @@ def test_seg(args):
     if args.pretrained:
         single_model.load_state_dict(torch.load(args.pretrained))
     model = torch.nn.DataParallel(single_model).cuda()
+    # NHWC conv kernels have higher tensor-core occupancy on Ampere+.
+    model = model.to(memory_format=torch.channels_last).eval()
 
     data_dir = args.data_dir
     info = json.load(open(join(data_dir, 'info.json'), 'r'))
-    normalize = data_transforms.Normalize(mean=info['mean'], std=info['std'])
+    # Workers only decode and hand over uint8 CHW tensors (1 byte/pixel
+    # across the loader boundary and the PCIe bus); scaling and
+    # normalization run fused on the GPU after the H2D copy.  For the
+    # multi-scale dataset this also removes five CPU normalize passes per
+    # image.
+    mean_gpu = torch.tensor(
+        info['mean'], dtype=torch.float32).view(1, -1, 1, 1).cuda()
+    std_gpu = torch.tensor(
+        info['std'], dtype=torch.float32).view(1, -1, 1, 1).cuda()
     scales = [0.5, 0.75, 1.25, 1.5, 1.75]
+    has_gt = phase != 'test' or args.with_gt
     if args.ms:
         dataset = SegListMS(data_dir, phase, data_transforms.Compose([
-            data_transforms.ToTensor(),
-            normalize,
-        ]), scales, list_dir=args.list_dir)
+            data_transforms.ToTensorUint8(),
+        ]), scales, list_dir=args.list_dir, has_gt=has_gt)
     else:
         dataset = SegList(data_dir, phase, data_transforms.Compose([
-            data_transforms.ToTensor(),
-            normalize,
-        ]), list_dir=args.list_dir, out_name=True)
-    test_loader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=batch_size, shuffle=False, num_workers=num_workers,
-        pin_memory=False
-    )
+            data_transforms.ToTensorUint8(),
+        ]), list_dir=args.list_dir, out_name=True, has_gt=has_gt)
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=True)
+    if num_workers > 0:
+        # Keep the transform workers alive and a few batches ahead; the
+        # per-sample transforms on 2MP images dominate the CPU time here.
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    if args.ms:
+        # Bucket same-size images into real batches; the small 0.5x/0.75x
+        # forwards leave most of the GPU idle at batch_size=1.
+        test_loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=BucketBatchSampler(dataset, batch_size),
+            **loader_kwargs
+        )
+    else:
+        test_loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batch_size, shuffle=False, **loader_kwargs
+        )
+    if torch.cuda.is_available():
+        test_loader = CUDAPrefetcher(test_loader)
 
     cudnn.benchmark = True
 
@@ -819,15 +1170,31 @@ def test_seg(args):
     if args.resume:
         if os.path.isfile(args.resume):
             logger.info("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            # mmap the tensor storages straight from disk instead of
+            # buffering the whole pickle stream (2x checkpoint size in RAM);
+            # weights_only also skips arbitrary-object unpickling.  Mapping
+            # onto the GPU sends each storage over PCIe as it is read, so
+            # load_state_dict below only does device-side copies instead of
+            # staging a full CPU replica of the model first.
+            checkpoint = torch.load(args.resume, map_location='cuda',
+                                    mmap=True, weights_only=True)
             start_epoch = checkpoint['epoch']
             best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
+            model.load_state_dict(
+                strip_compile_prefix(checkpoint['state_dict']))
             logger.info("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.resume, checkpoint['epoch']))
         else:
             logger.info("=> no checkpoint found at '{}'".format(args.resume))
 
+    if torch.cuda.is_available() and hasattr(torch, 'compile'):
+        # At the fixed eval resolution, reduce-overhead replays the forward
+        # as CUDA graphs and drops the per-kernel launch latency.  The
+        # multi-scale loop sees several input shapes, so keep dynamic
+        # shapes on there rather than recompiling per scale.
+        model = torch.compile(model, mode='reduce-overhead',
+                              fullgraph=False, dynamic=args.ms)
+
     out_dir = '{}_{:03d}_{}'.format(args.arch, start_epoch, phase)
     if len(args.test_suffix) > 0:
         out_dir += '_' + args.test_suffix
@@ -836,18 +1203,19 @@ def test_seg(args):
 
     if args.ms:
         mAP = test_ms(test_loader, model, args.classes, save_vis=True,
-                      has_gt=phase != 'test' or args.with_gt,
-                      output_dir=out_dir,
-                      scales=scales)
+                      has_gt=has_gt, output_dir=out_dir,
+                      scales=scales, mean=mean_gpu, std=std_gpu,
+                      amp=args.amp)
     else:
         mAP = test(test_loader, model, args.classes, save_vis=True,
-                   has_gt=phase != 'test' or args.with_gt, output_dir=out_dir)
+                   has_gt=has_gt, output_dir=out_dir,
+                   mean=mean_gpu, std=std_gpu, amp=args.amp)
     logger.info('mAP: %f', mAP)
 
 
 def parse_args():
     # Training settings
-    parser = argparse.ArgumentParser(description='')
+    parser = argparse.ArgumentParser(description='', allow_abbrev=False)
     parser.add_argument('cmd', choices=['train', 'test'])
     parser.add_argument('-d', '--data-dir', default=None, required=True)
     parser.add_argument('-l', '--list-dir', default=None,
@@ -881,7 +1249,12 @@ def parse_args():
     parser.add_argument('--save_iter', default=1, type=int,
                         help='number of training iterations between'
                              'checkpoint history saves')
-    parser.add_argument('-j', '--workers', type=int, default=8)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of dataloader workers; defaults to'
+                             ' min(cpu count, 2 * batch size)')
+    parser.add_argument('--cache-dir', default=None, type=str,
+                        help='If set, decoded images are cached there as raw'
+                             ' .npy files and memory-mapped on later reads.')
     parser.add_argument('--load-release', dest='load_rel', default=None)
     parser.add_argument('--phase', default='val')
     parser.add_argument('--random-scale', default=0, type=float)
@@ -889,22 +1262,27 @@ def parse_args():
     parser.add_argument('--bn-sync', action='store_true')
     parser.add_argument('--ms', action='store_true',
                         help='Turn on multi-scale testing')
+    parser.add_argument('--amp', dest='amp', action='store_true',
+                        default=True,
+                        help='Run the test forward under mixed-precision '
+                             'autocast (default on; disable with --no-amp).')
+    parser.add_argument('--no-amp', dest='amp', action='store_false')
     parser.add_argument('--with-gt', action='store_true')
     parser.add_argument('--test-suffix', default='', type=str)
     parser.add_argument('--use-loss-prediction-al',
                         dest='use_loss_prediction_al',
-                        default=False, type=bool,
-                        help='If True, will use loss prediction active learning algorithm.')
+                        action='store_true',
+                        help='Use the loss prediction active learning algorithm.')
     parser.add_argument('--choose_images_with_highest_loss',
                         dest='choose_images_with_highest_loss',
-                        default=False, type=bool,
-                        help='If True, will use ground truth labels to select the images with highest loss.')
+                        action='store_true',
+                        help='Use ground truth labels to select the images with highest loss.')
     parser.add_argument('--lamda', default=1, type=float,
                         help='Loss prediction active learning loss weight')
     parser.add_argument('--use-discriminative-al',
                         dest='use_discriminative_al',
-                        default=False, type=bool,
-                        help='If True, will use discriminative active learning algorithm.')
+                        action='store_true',
+                        help='Use the discriminative active learning algorithm.')
     parser.add_argument('--output_superannotate_csv_file',
                         required=False,
                         type=str,
@@ -915,10 +1293,23 @@ def parse_args():
 
     assert args.classes > 0
 
+    if args.workers is None:
+        # Scale with the host instead of a hard-coded 8: 8 workers thrash a
+        # 4-core box and starve a 96-core one.  Past 2x the batch size extra
+        # workers only add context switches, so cap there as well.
+        args.workers = min(os.cpu_count() or 1, max(2, 2 * args.batch_size))
+    elif args.workers > 2 * args.batch_size:
+        logger.warning('--workers %d exceeds 2 x batch size (%d); the extra'
+                       ' workers will mostly idle', args.workers,
+                       2 * args.batch_size)
+    logger.info('Using %d dataloader workers', args.workers)
+
     print(' '.join(sys.argv))
     print(args)
 
     if args.bn_sync:
+        import drn
+        from modules import batchnormsync
         drn.BatchNorm = batchnormsync.BatchNormSync
 
     return args